@@ -8,10 +8,25 @@ class Settings(BaseModel):
     GEMINI_API_KEY: str = os.getenv("GEMINI_API_KEY", "")
     GEMINI_IMAGE_MODEL: str = os.getenv("GEMINI_IMAGE_MODEL", "gemini-2.5-flash-image")
 
-    # retry behavior for 429
+    # retry behavior for 429 / transient 5xx (exponential backoff with jitter)
     GEMINI_MAX_RETRIES: int = int(os.getenv("GEMINI_MAX_RETRIES", "5"))
     GEMINI_RETRY_BASE_SECONDS: float = float(os.getenv("GEMINI_RETRY_BASE_SECONDS", "2.0"))
 
+    # Long-edge cap for images sent to OpenRouter (re-encoded as JPEG); 0 disables
+    MAX_UPLOAD_DIM: int = int(os.getenv("MAX_UPLOAD_DIM", "1536"))
+
+    # "gemini" (OpenRouter) or "local" (InsightFace + inswapper)
+    FACE_SWAP_PROVIDER: str = os.getenv("FACE_SWAP_PROVIDER", "gemini").lower()
+    INSWAPPER_PATH: str = os.getenv("INSWAPPER_PATH", "./models/inswapper_128.onnx")
+    # InsightFace pack used for detection only (buffalo_s = SCRFD-500MF)
+    INSIGHTFACE_MODEL: str = os.getenv("INSIGHTFACE_MODEL", "buffalo_s")
+    # Recognition model as "<pack>/<file>". inswapper's emap was trained on
+    # buffalo_l's w600k_r50 embeddings; other recognizers live in a different space.
+    INSIGHTFACE_REC_MODEL: str = os.getenv("INSIGHTFACE_REC_MODEL", "buffalo_l/w600k_r50.onnx")
+
+    # 1 = also run a full PIL verify on uploads (default is a magic-number sniff)
+    STRICT_IMAGE_VALIDATION: bool = os.getenv("STRICT_IMAGE_VALIDATION", "0") == "1"
+
     LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
 
 settings = Settings()
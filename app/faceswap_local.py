@@ -1,10 +1,15 @@
 import logging
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
 import cv2
+import numpy as np
 import insightface
 from insightface.app import FaceAnalysis
+from insightface.app.common import Face
 from insightface.model_zoo import get_model
+from insightface.model_zoo.scrfd import distance2bbox, distance2kps
+from insightface.utils import ensure_available
 # import insightface
 # from insightface.app import FaceAnalysis
 # from insightface.model_zoo import get_model
@@ -13,23 +18,75 @@ from app.config import settings
 
 log = logging.getLogger("faceswap")
 
+# Prefer CUDA; onnxruntime falls back to CPU when CUDA isn't available
+ONNX_PROVIDERS = ["CUDAExecutionProvider", "CPUExecutionProvider"]
+
+# Detection runs at det_size anyway; cap the long edge before handing images to FaceAnalysis
+DET_MAX_SIDE = 1280
+
+# Output encode + write (cv2 releases the GIL) runs here, off the swap slot
+_IO_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="faceswap-io")
+
 class LocalFaceSwapper:
     def __init__(self):
         if not Path(settings.INSWAPPER_PATH).exists():
             raise RuntimeError(f"inswapper model not found at: {settings.INSWAPPER_PATH}")
 
-        # Face detector/recognition pipeline
-        self.app = FaceAnalysis(name="buffalo_l")
+        # Face detector from the (small) pack. The swap only needs bbox/kps + embedding,
+        # so skip the landmark and genderage heads entirely.
+        self.app = FaceAnalysis(
+            name=settings.INSIGHTFACE_MODEL,
+            allowed_modules=["detection"],
+            providers=ONNX_PROVIDERS,
+        )
         # ctx_id=0 uses GPU if available; on CPU-only machines this still works in many cases
         # If it fails, set ctx_id=-1
         self.app.prepare(ctx_id=0, det_size=(640, 640))
+        log.info("Detector providers=%s", self.app.models["detection"].session.get_providers())
+
+        # Embeddings must come from the recognizer inswapper was trained against,
+        # whatever pack detection uses; registered so the per-face pass picks it up
+        pack, _, rec_file = settings.INSIGHTFACE_REC_MODEL.partition("/")
+        rec_path = Path(ensure_available("models", pack)) / rec_file
+        rec = get_model(str(rec_path), providers=ONNX_PROVIDERS)
+        if rec is None or rec.taskname != "recognition":
+            raise RuntimeError(f"Not a recognition model: {rec_path}")
+        rec.prepare(ctx_id=0)
+        self.app.models["recognition"] = rec
+        log.info("Recognition model=%s providers=%s", rec_path, rec.session.get_providers())
 
         # Load local ONNX swapper (NO download)
-        self.swapper = get_model(settings.INSWAPPER_PATH, download=False)
+        self.swapper = get_model(settings.INSWAPPER_PATH, providers=ONNX_PROVIDERS, download=False)
+        log.info("Swapper providers=%s", self.swapper.session.get_providers())
 
-        log.info("InsightFace version=%s", insightface.__version__)
+        log.info("InsightFace version=%s det pack=%s", insightface.__version__, settings.INSIGHTFACE_MODEL)
         log.info("Loaded inswapper model from=%s", settings.INSWAPPER_PATH)
 
+        # Cleared if the detector graph turns out not to accept a batch of 2
+        self._batch_det = True
+
+        self._warmup()
+
+    def _warmup(self):
+        # Run each ONNX session once on dummy input so kernel selection / CUDA
+        # context setup happens now instead of during the first job. Detection
+        # goes through the same batch-of-2 path as jobs, which also settles the
+        # _batch_det probe at boot.
+        blank = np.zeros((640, 640, 3), dtype=np.uint8)
+        self._det_batch([blank, blank])
+
+        rec = self.app.models.get("recognition")
+        if rec is not None:
+            w, h = rec.input_size
+            rec.get_feat(np.zeros((h, w, 3), dtype=np.uint8))
+
+        w, h = self.swapper.input_size
+        self.swapper.session.run(self.swapper.output_names, {
+            self.swapper.input_names[0]: np.zeros((1, 3, h, w), dtype=np.float32),
+            self.swapper.input_names[1]: np.zeros((1, 512), dtype=np.float32),
+        })
+        log.info("Warmed up InsightFace + inswapper sessions")
+
     @staticmethod
     def _pick_largest_face(faces):
         return max(
@@ -37,18 +94,126 @@ class LocalFaceSwapper:
             key=lambda f: (f.bbox[2] - f.bbox[0]) * (f.bbox[3] - f.bbox[1])
         )
 
-    def swap(self, base_path: str, selfie_path: str, out_path: str):
-        log.info("Reading images base=%s selfie=%s", base_path, selfie_path)
-        base_img = cv2.imread(base_path)
-        selfie_img = cv2.imread(selfie_path)
-
-        if base_img is None:
-            raise ValueError("Failed to read BASE image via OpenCV.")
-        if selfie_img is None:
-            raise ValueError("Failed to read SELFIE image via OpenCV.")
-
-        base_faces = self.app.get(base_img)
-        selfie_faces = self.app.get(selfie_img)
+    @staticmethod
+    def _downscale(img):
+        """Returns (img, scale) with the long edge capped at DET_MAX_SIDE."""
+        h, w = img.shape[:2]
+        scale = min(1.0, DET_MAX_SIDE / max(h, w))
+        if scale >= 1.0:
+            return img, 1.0
+        return cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA), scale
+
+    def _letterbox(self, img):
+        # Same resize + top-left padding as SCRFD.detect
+        in_w, in_h = self.app.det_model.input_size
+        im_ratio = float(img.shape[0]) / img.shape[1]
+        if im_ratio > float(in_h) / in_w:
+            new_h, new_w = in_h, int(in_h / im_ratio)
+        else:
+            new_w, new_h = in_w, int(in_w * im_ratio)
+        det_img = np.zeros((in_h, in_w, 3), dtype=np.uint8)
+        det_img[:new_h, :new_w, :] = cv2.resize(img, (new_w, new_h))
+        return det_img, float(new_h) / img.shape[0]
+
+    def _decode_detections(self, net_outs, det_scale):
+        """
+        SCRFD post-processing (anchor decode + NMS) for one image's outputs,
+        mirroring SCRFD.forward/detect. Returns (bboxes with score column, kpss).
+        """
+        det = self.app.det_model
+        in_w, in_h = det.input_size
+        fmc = det.fmc
+        scores_list, bboxes_list, kpss_list = [], [], []
+        for idx, stride in enumerate(det._feat_stride_fpn):
+            height, width = in_h // stride, in_w // stride
+            key = (height, width, stride)
+            anchor_centers = det.center_cache.get(key)
+            if anchor_centers is None:
+                anchor_centers = np.stack(np.mgrid[:height, :width][::-1], axis=-1).astype(np.float32)
+                anchor_centers = (anchor_centers * stride).reshape((-1, 2))
+                if det._num_anchors > 1:
+                    anchor_centers = np.stack([anchor_centers] * det._num_anchors, axis=1).reshape((-1, 2))
+                det.center_cache[key] = anchor_centers
+
+            scores = net_outs[idx]
+            pos_inds = np.where(scores >= det.det_thresh)[0]
+            bboxes = distance2bbox(anchor_centers, net_outs[idx + fmc] * stride)
+            scores_list.append(scores[pos_inds])
+            bboxes_list.append(bboxes[pos_inds])
+            if det.use_kps:
+                kpss = distance2kps(anchor_centers, net_outs[idx + fmc * 2] * stride)
+                kpss_list.append(kpss.reshape((kpss.shape[0], -1, 2))[pos_inds])
+
+        order = np.vstack(scores_list).ravel().argsort()[::-1]
+        pre_det = np.hstack((np.vstack(bboxes_list) / det_scale, np.vstack(scores_list)))
+        pre_det = pre_det.astype(np.float32, copy=False)[order, :]
+        keep = det.nms(pre_det)
+        kpss = None
+        if det.use_kps:
+            kpss = (np.vstack(kpss_list) / det_scale)[order, :, :][keep, :, :]
+        return pre_det[keep, :], kpss
+
+    def _det_batch(self, imgs):
+        """
+        Runs the SCRFD detector once on all images stacked as an NCHW batch.
+        Falls back to one detect() per image if the graph has a fixed batch size.
+        """
+        det = self.app.det_model
+        batch_dim = det.input_shape[0]
+        if self._batch_det and isinstance(batch_dim, int) and batch_dim != len(imgs):
+            self._batch_det = False
+            log.info("Detector has fixed batch size %s; detecting images one at a time", batch_dim)
+
+        if self._batch_det:
+            letterboxed = [self._letterbox(img) for img in imgs]
+            blob = cv2.dnn.blobFromImages(
+                [det_img for det_img, _ in letterboxed], 1.0 / det.input_std, det.input_size,
+                (det.input_mean, det.input_mean, det.input_mean), swapRB=True,
+            )
+            try:
+                net_outs = det.session.run(det.output_names, {det.input_name: blob})
+            except Exception as e:
+                self._batch_det = False
+                log.warning("Batched detection failed (%s); detecting images one at a time", str(e))
+            else:
+                # (N, K, C) for batched exports, (N*K, C) otherwise -> per-image (K, C)
+                per_output = [o.reshape(len(imgs), -1, o.shape[-1]) for o in net_outs]
+                return [
+                    self._decode_detections([o[i] for o in per_output], det_scale)
+                    for i, (_, det_scale) in enumerate(letterboxed)
+                ]
+
+        return [det.detect(img, max_num=0, metric="default") for img in imgs]
+
+    def _detect_pair(self, base_img, selfie_img):
+        """
+        Detects faces on both images with a single detector run, on copies
+        downscaled to DET_MAX_SIDE, and maps bbox/kps back to full resolution
+        (the embedding is scale-independent).
+        """
+        scaled = [self._downscale(img) for img in (base_img, selfie_img)]
+        detections = self._det_batch([img for img, _ in scaled])
+
+        results = []
+        for (img, scale), (bboxes, kpss) in zip(scaled, detections):
+            faces = []
+            for i in range(bboxes.shape[0]):
+                face = Face(bbox=bboxes[i, 0:4], kps=None if kpss is None else kpss[i], det_score=bboxes[i, 4])
+                # Same per-face pass as FaceAnalysis.get (recognition -> embedding)
+                for taskname, model in self.app.models.items():
+                    if taskname != "detection":
+                        model.get(img, face)
+                if scale < 1.0:
+                    face.bbox = face.bbox / scale
+                    if face.kps is not None:
+                        face.kps = face.kps / scale
+                faces.append(face)
+            results.append(faces)
+        return results
+
+    def swap(self, base_img: np.ndarray, selfie_img: np.ndarray, out_path: str) -> Future:
+        # Inputs arrive decoded (BGR, 3 channels); see utils.validate_and_decode
+        base_faces, selfie_faces = self._detect_pair(base_img, selfie_img)
 
         if not base_faces:
             raise ValueError("No face detected in BASE image.")
@@ -61,11 +226,16 @@ class LocalFaceSwapper:
         log.info("Swapping face (selfie -> base)")
         result = self.swapper.get(base_img, dst_face, src_face, paste_back=True)
 
+        # Encode + write in the background, off the swap slot; the caller must
+        # join the returned future before treating out_path as done
         Path(out_path).parent.mkdir(parents=True, exist_ok=True)
-        ok = cv2.imwrite(out_path, result)
-        if not ok:
-            raise RuntimeError("Failed to write output image.")
-        log.info("Wrote output=%s", out_path)
+        return _IO_POOL.submit(_write_image, out_path, result)
+
+def _write_image(out_path: str, img):
+    ok = cv2.imwrite(out_path, img)
+    if not ok:
+        raise RuntimeError("Failed to write output image.")
+    log.info("Wrote output=%s", out_path)
 
 _swapper = None
 
@@ -75,6 +245,11 @@ def _get_swapper():
         _swapper = LocalFaceSwapper()
     return _swapper
 
-def face_swap_local(base_path: str, selfie_path: str, out_path: str):
-    return _get_swapper().swap(base_path, selfie_path, out_path)
+def preload_swapper():
+    """Load and warm the models once, at app startup."""
+    _get_swapper()
+
+def face_swap_local(base_img: np.ndarray, selfie_img: np.ndarray, out_path: str) -> Future:
+    """Runs the swap and returns the future of the background output write."""
+    return _get_swapper().swap(base_img, selfie_img, out_path)
 
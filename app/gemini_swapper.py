@@ -1,11 +1,23 @@
+import asyncio
 import base64
-import json
+import binascii
 import logging
 import os
+import random
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 from dotenv import load_dotenv
-import requests
+import cv2
+import httpx
+import ijson
+import orjson
+from PIL import Image
+
+from app.config import settings
 
 load_dotenv()
 
@@ -23,19 +35,140 @@ log = logging.getLogger("openrouter_gemini_faceswap")
 LOG_PAYLOAD_PREVIEW_CHARS = int(os.getenv("LOG_PAYLOAD_PREVIEW_CHARS", "1200"))
 LOG_RESPONSE_PREVIEW_CHARS = int(os.getenv("LOG_RESPONSE_PREVIEW_CHARS", "2000"))
 
+# Statuses worth retrying (throttling / transient upstream failures)
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+RETRY_MAX_DELAY_SECONDS = 30.0
+
+# Base64 encode: read in multiples of 3 bytes so chunks encode without padding
+B64_READ_CHUNK = 57000
+# Base64 decode: slice the input in multiples of 4 chars so chunks decode independently
+B64_DECODE_CHUNK = 65536
+
+UPLOAD_JPEG_QUALITY = 85
+
+# Shared async client: keeps TCP+TLS (HTTP/2) connections to openrouter.ai alive
+# across jobs so many in-flight requests share one event loop thread.
+# Retries are handled explicitly in face_swap_gemini.
+_HTTPX = httpx.AsyncClient(http2=True, timeout=180, limits=httpx.Limits(max_connections=32))
+
+# Transport errors worth retrying (connection drops, timeouts)
+RETRYABLE_TRANSPORT_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
 
 # --------------------------
 # Helpers
 # --------------------------
+class BufferPool:
+    """
+    Small process-wide pool of reusable bytearrays. Buffers grow on demand and
+    are trimmed back to target_bytes on release if they grew past twice that,
+    so one huge image doesn't pin a huge buffer for the process lifetime.
+    """
+
+    def __init__(self, max_buffers: int = 4, target_bytes: int = 8 * 1024 * 1024):
+        self.max_buffers = max_buffers
+        self.target_bytes = target_bytes
+        self._free: List[bytearray] = []
+        self._lock = threading.Lock()
+
+    def acquire(self, size: int) -> bytearray:
+        with self._lock:
+            buf = self._free.pop() if self._free else bytearray()
+        if len(buf) < size:
+            buf.extend(bytes(size - len(buf)))
+        return buf
+
+    def release(self, buf: bytearray) -> None:
+        if len(buf) > 2 * self.target_bytes:
+            del buf[self.target_bytes:]
+        with self._lock:
+            if len(self._free) < self.max_buffers:
+                self._free.append(buf)
+
+
+# Base64 output of outgoing images / decoded bytes of the returned image
+_B64_POOL = BufferPool()
+_DECODE_POOL = BufferPool()
+
+# Durability of output files is handled off the job's path
+_FSYNC_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="fsync")
+
+
+def _fsync_and_close(fd: int, path: str) -> None:
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        log.warning("fsync failed for %s: %s", path, str(e))
+    finally:
+        os.close(fd)
+
+
+def write_output_file(path: str, data) -> None:
+    """
+    Writes data via a raw fd and returns once it is in the page cache. The file
+    is about to be fetched through the static mount, so pages are hinted
+    WILLNEED; the fsync runs on a background thread.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # Views are released even on error: data may live in a pooled buffer
+        # that is resized on release
+        with memoryview(data) as view:
+            size = view.nbytes
+            written = 0
+            while written < size:
+                with view[written:] as rest:
+                    written += os.write(fd, rest)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+    except BaseException:
+        os.close(fd)
+        raise
+    _FSYNC_POOL.submit(_fsync_and_close, fd, path)
+
+
+def downscale_for_upload(image_path: str) -> Optional[bytes]:
+    """
+    Returns JPEG bytes resized to MAX_UPLOAD_DIM on the long edge, or None when
+    the image is already small enough to send as-is. The model downsamples
+    anyway, so extra pixels only cost upload time.
+    """
+    if settings.MAX_UPLOAD_DIM <= 0:
+        return None
+    with Image.open(image_path) as img:  # header only, no pixel decode
+        width, height = img.size
+    scale = settings.MAX_UPLOAD_DIM / max(width, height)
+    if scale >= 1.0:
+        return None
+
+    img = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"Failed to decode image: {image_path}")
+    small = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    ok, enc = cv2.imencode(".jpg", small, [cv2.IMWRITE_JPEG_QUALITY, UPLOAD_JPEG_QUALITY])
+    if not ok:
+        raise RuntimeError(f"Failed to re-encode image: {image_path}")
+    log.info("Downscaled %s from %dx%d for upload (%d bytes)", image_path, width, height, enc.nbytes)
+    return enc.tobytes()
+
+
 def encode_image_to_data_url(image_path: str) -> str:
     """
     Reads image bytes and returns a data URL like:
     data:image/jpeg;base64,....
+
+    Images larger than MAX_UPLOAD_DIM are re-encoded as a smaller JPEG first.
+    Otherwise the file is base64-encoded chunk by chunk into a pooled buffer,
+    so the raw bytes and an intermediate encoded copy are never held in memory.
     """
     p = Path(image_path)
     if not p.exists():
         raise FileNotFoundError(f"Image not found: {image_path}")
 
+    jpeg = downscale_for_upload(image_path)
+    if jpeg is not None:
+        return "data:image/jpeg;base64," + base64.b64encode(jpeg).decode("ascii")
+
     # Cheap MIME guess based on extension (works fine for most cases)
     ext = p.suffix.lower()
     if ext in [".jpg", ".jpeg"]:
@@ -48,13 +181,34 @@ def encode_image_to_data_url(image_path: str) -> str:
         # Default; still works often
         mime = "image/jpeg"
 
-    b64 = base64.b64encode(p.read_bytes()).decode("utf-8")
-    return f"data:{mime};base64,{b64}"
-
-
-def decode_data_url_to_bytes(data_url: str) -> Tuple[bytes, str]:
+    prefix = f"data:{mime};base64,".encode("ascii")
+    with open(p, "rb", buffering=1 << 20) as f:
+        size = os.fstat(f.fileno()).st_size
+        buf = _B64_POOL.acquire(len(prefix) + 4 * -(-size // 3))
+        try:
+            # The view must be released before the buffer goes back to the pool
+            with memoryview(buf) as view:
+                view[:len(prefix)] = prefix
+                n = len(prefix)
+                # Only encode the size fstat reported, which the buffer was sized for
+                remaining = size
+                while remaining > 0:
+                    chunk = f.read(min(B64_READ_CHUNK, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    encoded = base64.b64encode(chunk)
+                    view[n:n + len(encoded)] = encoded
+                    n += len(encoded)
+                with view[:n] as encoded_view:
+                    return str(encoded_view, "ascii")
+        finally:
+            _B64_POOL.release(buf)
+
+
+def parse_data_url(data_url: str) -> Tuple[str, str]:
     """
-    Takes data:image/png;base64,... and returns (bytes, mime_type).
+    Takes data:image/png;base64,... and returns (mime_type, base64_payload).
     """
     if not data_url.startswith("data:"):
         raise ValueError("Expected a data URL: data:image/...;base64,....")
@@ -62,7 +216,32 @@ def decode_data_url_to_bytes(data_url: str) -> Tuple[bytes, str]:
     header, b64data = data_url.split(",", 1)
     # header example: data:image/png;base64
     mime = header.split(";")[0].replace("data:", "").strip()
-    return base64.b64decode(b64data), mime
+    return mime, b64data
+
+
+def write_base64_to_file(b64data: str, path: str) -> int:
+    """
+    Decodes base64 text into a pooled buffer in fixed-size chunks and writes it
+    to path, without allocating a full-size bytes object per call. Returns the
+    number of bytes written.
+    """
+    if "\n" in b64data or "\r" in b64data:
+        # Line-wrapped base64 would break the 4-char chunk alignment
+        b64data = "".join(b64data.split())
+
+    buf = _DECODE_POOL.acquire(len(b64data) // 4 * 3)
+    try:
+        n = 0
+        with memoryview(buf) as view:
+            for i in range(0, len(b64data), B64_DECODE_CHUNK):
+                raw = binascii.a2b_base64(b64data[i:i + B64_DECODE_CHUNK])
+                view[n:n + len(raw)] = raw
+                n += len(raw)
+            with view[:n] as out:
+                write_output_file(path, out)
+        return n
+    finally:
+        _DECODE_POOL.release(buf)
 
 
 def safe_preview(s: str, max_chars: int) -> str:
@@ -72,6 +251,105 @@ def safe_preview(s: str, max_chars: int) -> str:
     return s if len(s) <= max_chars else s[:max_chars] + "...(truncated)"
 
 
+def body_preview(content: bytes, max_chars: int) -> str:
+    """Preview of a raw response body that only decodes its first bytes."""
+    return safe_preview(content[:max_chars + 1].decode("utf-8", "replace"), max_chars)
+
+
+class _AsyncBodyReader:
+    """Async file-like view of a streaming httpx response for ijson; keeps the first bytes for logging."""
+
+    def __init__(self, resp: httpx.Response, head_bytes: int):
+        self._chunks = resp.aiter_bytes()
+        self._head_bytes = head_bytes
+        self.head = b""
+
+    async def read(self, size: int = -1) -> bytes:
+        if size == 0:
+            # ijson probes with read(0) to detect bytes vs str
+            return b""
+        try:
+            chunk = await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return b""
+        if len(self.head) < self._head_bytes:
+            self.head += chunk[:self._head_bytes - len(self.head)]
+        return chunk
+
+
+IMAGE_URL_PREFIX = "choices.item.message.images.item.image_url.url"
+
+
+async def stream_extract_response(reader: _AsyncBodyReader) -> dict:
+    """
+    Walks the response JSON incrementally and stops at the first image data URL.
+    Returns a sparse dict shaped like the full response, holding only the fields
+    face_swap_gemini reads (error, provider, usage, message content, first image),
+    so the rest of a multi-MB body is never materialized.
+    """
+    resp_json: dict = {}
+    message: dict = {}
+    async for prefix, event, value in ijson.parse_async(reader):
+        if prefix == IMAGE_URL_PREFIX and event == "string":
+            message["images"] = [{"image_url": {"url": value}}]
+            break
+        if prefix == "" and event == "map_key":
+            # Record every top-level key (for logging); unneeded values stay None
+            resp_json.setdefault(value, None)
+        elif prefix == "choices.item.message.content" and event == "string":
+            message["content"] = value
+        elif prefix == "choices.item.message.content.item.text" and event == "string":
+            # Content given as a list of parts: keep the text parts, joined
+            message["content"] = f"{message['content']}\n{value}" if "content" in message else value
+        elif prefix == "provider" and event == "string":
+            resp_json["provider"] = value
+        elif prefix.startswith("error.") and event in ("string", "number", "boolean"):
+            resp_json["error"] = {**(resp_json.get("error") or {}), prefix[len("error."):]: value}
+        elif prefix.startswith("usage.") and event == "number":
+            resp_json["usage"] = {**(resp_json.get("usage") or {}), prefix[len("usage."):]: value}
+
+    if message or "choices" in resp_json:
+        resp_json["choices"] = [{"message": message}]
+    return resp_json
+
+
+async def read_response_json(resp: httpx.Response) -> Tuple[dict, bytes]:
+    """
+    Reads and closes a streamed response; returns (parsed JSON, raw body prefix).
+    Successful responses carry the image as a multi-MB string, so they are parsed
+    incrementally; error bodies are small and parsed whole.
+    """
+    try:
+        if resp.status_code < 400 and "json" in resp.headers.get("content-type", ""):
+            reader = _AsyncBodyReader(resp, max(LOG_RESPONSE_PREVIEW_CHARS + 1, 1001))
+            try:
+                resp_json = await stream_extract_response(reader)
+            except ijson.JSONError:
+                log.error("Non-JSON response body (first 1000 chars): %s", body_preview(reader.head, 1000))
+                raise
+            return resp_json, reader.head
+        await resp.aread()
+        try:
+            return orjson.loads(resp.content), resp.content
+        except Exception:
+            log.error("Non-JSON response body (first 1000 chars): %s", body_preview(resp.content, 1000))
+            resp.raise_for_status()
+            raise
+    finally:
+        await resp.aclose()
+
+
+class LazyJson:
+    """Log argument that serializes (and truncates) only if the record is emitted."""
+
+    def __init__(self, obj, max_chars: int):
+        self.obj = obj
+        self.max_chars = max_chars
+
+    def __str__(self) -> str:
+        return safe_preview(orjson.dumps(self.obj).decode("utf-8"), self.max_chars)
+
+
 def extract_openrouter_error(resp_json: dict) -> Optional[str]:
     """
     OpenRouter errors often appear as:
@@ -79,20 +357,46 @@ def extract_openrouter_error(resp_json: dict) -> Optional[str]:
     """
     err = resp_json.get("error")
     if isinstance(err, dict):
-        msg = err.get("message") or json.dumps(err)
+        msg = err.get("message") or orjson.dumps(err).decode("utf-8")
         return msg
     return None
 
 
+def retry_delay_seconds(attempt: int, retry_after: Optional[str] = None) -> float:
+    """
+    Exponential backoff with jitter, capped at RETRY_MAX_DELAY_SECONDS.
+    A Retry-After header (seconds or HTTP-date) overrides the computed delay.
+    """
+    delay = settings.GEMINI_RETRY_BASE_SECONDS * (2 ** attempt) * (1 + random.uniform(0, 0.5))
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                pass
+    return max(0.0, min(delay, RETRY_MAX_DELAY_SECONDS))
+
+
+async def close_http_client() -> None:
+    await _HTTPX.aclose()
+
+
 # --------------------------
 # Main function
 # --------------------------
-def face_swap_gemini(
+async def face_swap_gemini(
     base_path: str,
     selfie_path: str,
     out_path: str,
     model: str = "google/gemini-2.5-flash-image",
-) -> None:
+    executor: Optional[Executor] = None,
+) -> str:
+    """
+    Runs the swap and returns the output path (extension follows the returned mime).
+    Blocking encode/write work runs on executor (the loop's default pool if None).
+    """
     api_key = os.getenv("OPENROUTER_API_KEY", "").strip()
     if not api_key:
         raise RuntimeError("OPENROUTER_API_KEY is not set")
@@ -101,10 +405,14 @@ def face_swap_gemini(
     log.info("Base image: %s", base_path)
     log.info("Selfie image: %s", selfie_path)
 
+    loop = asyncio.get_running_loop()
+
     # 1) Encode local images as data URLs
     try:
-        base_data_url = encode_image_to_data_url(base_path)
-        selfie_data_url = encode_image_to_data_url(selfie_path)
+        base_data_url, selfie_data_url = await asyncio.gather(
+            loop.run_in_executor(executor, encode_image_to_data_url, base_path),
+            loop.run_in_executor(executor, encode_image_to_data_url, selfie_path),
+        )
         log.info("Encoded images to data URLs (lengths: base=%d selfie=%d)",
                  len(base_data_url), len(selfie_data_url))
     except Exception as e:
@@ -154,40 +462,59 @@ def face_swap_gemini(
     }
 
     # Log a sanitized preview (no giant base64 dump)
-    payload_preview = json.dumps(
-        {**payload, "messages": [{"role": "user", "content": [
+    if log.isEnabledFor(logging.INFO):
+        payload_preview = {**payload, "messages": [{"role": "user", "content": [
             {"type": "text", "text": prompt_text},
             {"type": "text", "text": "BASE IMAGE:"},
             {"type": "image_url", "image_url": {"url": f"<data_url length={len(base_data_url)}>" }},
             {"type": "text", "text": "SELFIE IMAGE:"},
             {"type": "image_url", "image_url": {"url": f"<data_url length={len(selfie_data_url)}>" }},
-        ]}]},
-        ensure_ascii=False
-    )
-    log.info("Payload preview: %s", safe_preview(payload_preview, LOG_PAYLOAD_PREVIEW_CHARS))
+        ]}]}
+        log.info("Payload preview: %s", LazyJson(payload_preview, LOG_PAYLOAD_PREVIEW_CHARS))
+
+    # orjson copies the big base64 strings straight through instead of escaping char by char
+    body = orjson.dumps(payload)
 
     # 4) Send request
     url = "https://openrouter.ai/api/v1/chat/completions"
     log.info("POST %s", url)
 
-    try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=180)
-        log.info("HTTP status=%s", resp.status_code)
-    except Exception as e:
-        log.exception("Request failed before getting response: %s", str(e))
-        raise
-
-    # 5) Parse response JSON
-    try:
-        resp_json = resp.json()
-    except Exception:
-        log.error("Non-JSON response body (first 1000 chars): %s", safe_preview(resp.text, 1000))
-        resp.raise_for_status()
-        raise
-
-    # Log response keys + preview
-    log.info("Response top-level keys: %s", list(resp_json.keys()))
-    log.info("Response preview: %s", safe_preview(json.dumps(resp_json), LOG_RESPONSE_PREVIEW_CHARS))
+    max_attempts = max(1, settings.GEMINI_MAX_RETRIES)
+    for attempt in range(max_attempts):
+        last_attempt = attempt == max_attempts - 1
+        try:
+            req = _HTTPX.build_request("POST", url, headers=headers, content=body)
+            resp = await _HTTPX.send(req, stream=True)
+            log.info("HTTP status=%s (attempt %d/%d)", resp.status_code, attempt + 1, max_attempts)
+
+            if resp.status_code not in RETRYABLE_STATUS_CODES or last_attempt:
+                if resp.status_code in RETRYABLE_STATUS_CODES:
+                    log.error("Giving up after %d attempts: HTTP status=%s", max_attempts, resp.status_code)
+                # 5) Parse response JSON inside the attempt, so a connection dropped
+                # mid-body is retried like one dropped before the headers
+                resp_json, head = await read_response_json(resp)
+                break
+            await resp.aclose()
+        except RETRYABLE_TRANSPORT_ERRORS as e:
+            if last_attempt:
+                log.exception("Request failed after %d attempts: %s", max_attempts, str(e))
+                raise RuntimeError(f"OpenRouter request failed after {max_attempts} attempts: {e}") from e
+            delay = retry_delay_seconds(attempt)
+            log.warning("Request error (%s); retrying in %.1fs", str(e), delay)
+            await asyncio.sleep(delay)
+            continue
+        except Exception as e:
+            log.exception("Request failed: %s", str(e))
+            raise
+
+        delay = retry_delay_seconds(attempt, resp.headers.get("Retry-After"))
+        log.warning("Retryable HTTP status=%s; retrying in %.1fs", resp.status_code, delay)
+        await asyncio.sleep(delay)
+
+    # Log response keys + preview (from the raw body prefix; never re-serialize a multi-MB response)
+    if log.isEnabledFor(logging.INFO):
+        log.info("Response top-level keys: %s", list(resp_json.keys()))
+        log.info("Response preview: %s", body_preview(head, LOG_RESPONSE_PREVIEW_CHARS))
 
     # Handle OpenRouter errors
     err_msg = extract_openrouter_error(resp_json)
@@ -197,7 +524,7 @@ def face_swap_gemini(
 
     # Handle non-2xx
     if resp.status_code >= 400:
-        log.error("HTTP error status=%s body=%s", resp.status_code, safe_preview(resp.text, 1000))
+        log.error("HTTP error status=%s body=%s", resp.status_code, body_preview(head, 1000))
         resp.raise_for_status()
 
     # 6) Extract image output (OpenRouter images are in message.images) 
@@ -225,8 +552,7 @@ def face_swap_gemini(
         data_url = images[0]["image_url"]["url"]
         log.info("Got image data URL length=%d", len(data_url))
 
-        img_bytes, mime = decode_data_url_to_bytes(data_url)
-        log.info("Decoded image bytes=%d mime=%s", len(img_bytes), mime)
+        mime, b64data = parse_data_url(data_url)
 
         # Choose file extension based on mime
         ext = ".png"
@@ -237,9 +563,10 @@ def face_swap_gemini(
 
         out_path_final = str(Path(out_path).with_suffix(ext))
         Path(out_path_final).parent.mkdir(parents=True, exist_ok=True)
-        Path(out_path_final).write_bytes(img_bytes)
+        n = await loop.run_in_executor(executor, write_base64_to_file, b64data, out_path_final)
 
-        log.info("Saved output image: %s", out_path_final)
+        log.info("Saved output image: %s (bytes=%d mime=%s)", out_path_final, n, mime)
+        return out_path_final
 
     except Exception as e:
         log.exception("Failed to extract/save image: %s", str(e))
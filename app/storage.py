@@ -1,20 +1,43 @@
 import sqlite3
+import threading
 import time
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
+
+# Columns set_status may update besides status/updated_at_ms
+SETTABLE_FIELDS = {"result_path", "error", "processing_ms", "input_hash"}
+
+# UPDATE statements keyed by the sorted kwarg names, so each shape is built once
+# (and hits sqlite3's per-connection prepared-statement cache by identical SQL text)
+_STMT_CACHE: Dict[Tuple[str, ...], str] = {}
+
+def _update_sql(key: Tuple[str, ...]) -> str:
+    sql = _STMT_CACHE.get(key)
+    if sql is None:
+        fields = ["status=?", "updated_at_ms=?"] + [f"{k}=?" for k in key]
+        sql = f"UPDATE jobs SET {', '.join(fields)} WHERE reference_id=?"
+        _STMT_CACHE[key] = sql
+    return sql
+
+def input_key(base_hash: str, selfie_hash: str, swapper: str) -> str:
+    """Value stored in jobs.input_hash for a (base, selfie) pair run through swapper (provider + model)."""
+    return f"{swapper}:{base_hash}:{selfie_hash}"
 
 class JobStore:
     def __init__(self, db_path: str):
         self.db_path = db_path
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        # One shared connection in autocommit mode; writes are serialized by _lock
+        self._c = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._c.execute("PRAGMA journal_mode=WAL")
+        self._c.execute("PRAGMA synchronous=NORMAL")
+        self._c.execute("PRAGMA temp_store=MEMORY")
+        self._lock = threading.Lock()
         self._init()
 
-    def _conn(self):
-        return sqlite3.connect(self.db_path, check_same_thread=False)
-
     def _init(self):
-        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
-        with self._conn() as c:
-            c.execute("""
+        with self._lock:
+            self._c.execute("""
             CREATE TABLE IF NOT EXISTS jobs (
               reference_id TEXT PRIMARY KEY,
               status TEXT NOT NULL,
@@ -22,43 +45,59 @@ class JobStore:
               updated_at_ms INTEGER NOT NULL,
               result_path TEXT,
               error TEXT,
-              processing_ms INTEGER
+              processing_ms INTEGER,
+              input_hash TEXT
             )
             """)
-            c.commit()
+            # Databases created before input_hash existed
+            cols = {row[1] for row in self._c.execute("PRAGMA table_info(jobs)")}
+            if "input_hash" not in cols:
+                self._c.execute("ALTER TABLE jobs ADD COLUMN input_hash TEXT")
+            self._c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_input_hash ON jobs(input_hash)")
 
     def create(self, reference_id: str):
         now = int(time.time() * 1000)
-        with self._conn() as c:
-            c.execute(
+        with self._lock:
+            self._c.execute(
                 "INSERT INTO jobs(reference_id,status,created_at_ms,updated_at_ms) VALUES(?,?,?,?)",
                 (reference_id, "pending", now, now),
             )
-            c.commit()
 
     def set_status(self, reference_id: str, status: str, **kwargs):
+        unknown = set(kwargs) - SETTABLE_FIELDS
+        if unknown:
+            raise ValueError(f"Unknown job fields: {sorted(unknown)}")
+
         now = int(time.time() * 1000)
-        fields = ["status=?", "updated_at_ms=?"]
-        values = [status, now]
-        for k, v in kwargs.items():
-            fields.append(f"{k}=?")
-            values.append(v)
-        values.append(reference_id)
-        with self._conn() as c:
-            c.execute(f"UPDATE jobs SET {', '.join(fields)} WHERE reference_id=?", values)
-            c.commit()
+        key = tuple(sorted(kwargs))
+        values = [status, now, *(kwargs[k] for k in key), reference_id]
+        with self._lock:
+            self._c.execute(_update_sql(key), values)
 
     def get(self, reference_id: str) -> Optional[Dict[str, Any]]:
-        with self._conn() as c:
-            cur = c.execute("SELECT reference_id,status,result_path,error,processing_ms FROM jobs WHERE reference_id=?",
-                            (reference_id,))
-            row = cur.fetchone()
-            if not row:
-                return None
-            return {
-                "reference_id": row[0],
-                "status": row[1],
-                "result_path": row[2],
-                "error": row[3],
-                "processing_ms": row[4],
-            }
+        cur = self._c.execute("SELECT reference_id,status,result_path,error,processing_ms FROM jobs WHERE reference_id=?",
+                              (reference_id,))
+        row = cur.fetchone()
+        if not row:
+            return None
+        return {
+            "reference_id": row[0],
+            "status": row[1],
+            "result_path": row[2],
+            "error": row[3],
+            "processing_ms": row[4],
+        }
+
+    def find_cached(self, base_hash: str, selfie_hash: str, swapper: str) -> Optional[str]:
+        """result_path of the latest completed job with the same inputs and swapper, if any."""
+        cur = self._c.execute(
+            "SELECT result_path FROM jobs WHERE input_hash=? AND status='completed' AND result_path IS NOT NULL "
+            "ORDER BY updated_at_ms DESC LIMIT 1",
+            (input_key(base_hash, selfie_hash, swapper),),
+        )
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        with self._lock:
+            self._c.close()
@@ -1,21 +1,104 @@
+import hashlib
+import os
+import shutil
+import tempfile
 from pathlib import Path
+from typing import Optional
+
+import cv2
+import numpy as np
 from PIL import Image
-import shutil
+
+from app.config import settings
 
 ALLOWED_FORMATS = {"JPEG", "PNG", "WEBP"}
 
-def ensure_allowed_image(path: str):
+# Copy buffer for uploads (shutil default is 16 KB, too many syscalls for multi-MB images)
+UPLOAD_COPY_BUFFER = 1024 * 1024
+
+def sniff_image_format(path: str) -> Optional[str]:
+    """Returns "JPEG" / "PNG" / "WEBP" from the file's magic number, or None."""
+    with open(path, "rb") as f:
+        head = f.read(12)
+    if head[:3] == b"\xff\xd8\xff":
+        return "JPEG"
+    if head[:8] == b"\x89PNG\r\n\x1a\n":
+        return "PNG"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+def _verify_with_pil(path: str) -> str:
     try:
         with Image.open(path) as img:
             img.verify()
-            fmt = (img.format or "").upper()
+            return (img.format or "").upper()
     except Exception as e:
         raise ValueError(f"Invalid image file: {e}")
 
+def ensure_allowed_image(path: str):
+    if settings.STRICT_IMAGE_VALIDATION:
+        fmt = _verify_with_pil(path)
+    else:
+        try:
+            fmt = sniff_image_format(path)
+        except OSError as e:
+            raise ValueError(f"Invalid image file: {e}")
+
     if fmt not in ALLOWED_FORMATS:
         raise ValueError(f"Unsupported image format: {fmt or 'unknown'}. Allowed: {sorted(ALLOWED_FORMATS)}")
 
+def validate_and_decode(path: str) -> np.ndarray:
+    """
+    Validates the upload and decodes it to a BGR ndarray in one pass, for callers
+    that need the pixels anyway (local swapper).
+    """
+    ensure_allowed_image(path)
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    if img is None or img.ndim != 3 or img.shape[2] != 3:
+        raise ValueError("Invalid image file: could not decode image data")
+    return img
+
+def hash_file(path: str) -> str:
+    """128-bit BLAKE2b hex digest of the file contents, read in chunks."""
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+
+def _backing_fileno(fileobj) -> Optional[int]:
+    # SpooledTemporaryFile.fileno() forces a rollover to disk, so only use it once it has rolled over
+    if isinstance(fileobj, tempfile.SpooledTemporaryFile) and not getattr(fileobj, "_rolled", False):
+        return None
+    fileno = getattr(fileobj, "fileno", None)
+    if fileno is None:
+        return None
+    try:
+        return fileno()
+    except (OSError, ValueError):
+        return None
+
 def save_upload_to_path(upload_file, out_path: str):
     Path(out_path).parent.mkdir(parents=True, exist_ok=True)
-    with open(out_path, "wb") as f:
-        shutil.copyfileobj(upload_file.file, f)
+    src = upload_file.file
+    src.seek(0)
+
+    with open(out_path, "wb", buffering=UPLOAD_COPY_BUFFER) as f:
+        src_fd = _backing_fileno(src)
+        if src_fd is not None and hasattr(os, "sendfile"):
+            # Upload already spooled to disk: copy kernel-side
+            offset = src.tell()
+            remaining = os.fstat(src_fd).st_size - offset
+            try:
+                while remaining > 0:
+                    sent = os.sendfile(f.fileno(), src_fd, offset, min(remaining, 1 << 30))
+                    if sent == 0:
+                        break
+                    offset += sent
+                    remaining -= sent
+                return
+            except OSError:
+                # e.g. filesystem without sendfile support; restart with a buffered copy
+                f.seek(0)
+                f.truncate()
+                src.seek(0)
+
+        shutil.copyfileobj(src, f, length=UPLOAD_COPY_BUFFER)